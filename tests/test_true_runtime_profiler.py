@@ -0,0 +1,336 @@
+import faulthandler
+import importlib.util
+import os
+import re
+import struct
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir)
+sys.path.append(PROJECT_DIR)
+
+from true_runtime_profiler import (
+    BPFTRACE_SCRIPT,
+    PERF_RECORD_LOST,
+    PERF_RECORD_SAMPLE,
+    SUMMARY_RE,
+    PerfSyscallCounter,
+    TrueRuntimeProfiler,
+    _full_trace_regex,
+    _split_batch_trace,
+    _split_bpftrace_output,
+    _syscall_name,
+)
+
+NUMPY_FUNCTION = """
+import numpy as np
+
+
+def handler(event):
+    return int(np.arange({}).sum())
+"""
+
+SPLIT_TRACE = """\
+100 openat(AT_FDCWD, "/etc/hosts", O_RDONLY) = 3
+100 read(3, "127.0.0.1 localhost", 4096) = 19
+101 read(0,  <unfinished ...>
+100 close(3) = 0
+101 <... read resumed>"x", 1) = 1
+101 mmap(NULL, 4096, PROT_READ, MAP_PRIVATE, 3, 0) = 0x7f2a3c000000
+100 exit_group(0) = ?
+100 +++ exited with 0 +++
+"""
+
+STRACE_SUMMARY = """\
+% time     seconds  usecs/call     calls    errors syscall
+------ ----------- ----------- --------- --------- ----------------
+ 60.00    0.000600          10        60         2 openat
+ 40.00    0.000400           4       100           read
+------ ----------- ----------- --------- --------- ----------------
+100.00    0.001000           6       160         2 total
+"""
+
+BPFTRACE_OUTPUT = """\
+@trace:
+200 0 5
+200 1 -9
+
+@cnt[0]: 1
+@cnt[1]: 1
+
+@err[1]: 1
+
+@ns[0]: 2000
+@ns[1]: 1000
+"""
+
+BATCH_TRACE = """\
+openat(AT_FDCWD, "/before", O_RDONLY) = 3
+prctl(PR_SET_NAME, "PROF_BEG:0") = 0
+openat(AT_FDCWD, "/first", O_RDONLY) = 3
+prctl(PR_SET_NAME, "PROF_END:0") = 0
+close(3) = 0
+prctl(PR_SET_NAME, "PROF_BEG:1") = 0
+read(3, "", 4096) = 0
+write(1, "x", 1) = 1
+prctl(PR_SET_NAME, "PROF_END:1") = 0
+"""
+
+# Stands in for bpftrace: signals readiness like BPFTRACE_SCRIPT's BEGIN, then on SIGINT
+# writes one trace line for the traced PID and the END maps for syscall 0
+STUB_BPFTRACE = """\
+#!/usr/bin/env python3
+import os, signal, sys
+out = sys.argv[sys.argv.index("-o") + 1]
+pid = sys.argv[-1]
+with open(os.environ["STUB_BPFTRACE_SCRIPT"], "w") as f:
+    f.write(sys.argv[sys.argv.index("-e") + 1])
+with open(out, "w") as f:
+    f.write("@trace:\\n")
+def stop(signum, frame):
+    with open(out, "a") as f:
+        f.write(pid + " 0 5\\n\\n@cnt[0]: 2\\n\\n@err[0]: 1\\n\\n@ns[0]: 3000\\n")
+    sys.exit(0)
+signal.signal(signal.SIGINT, stop)
+while True:
+    signal.pause()
+"""
+
+
+class FullPythonBpftrace(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        bin_dir = os.path.join(self.tmp_dir.name, "bin")
+        os.makedirs(bin_dir)
+        stub = os.path.join(bin_dir, "bpftrace")
+        with open(stub, "w") as f:
+            f.write(STUB_BPFTRACE)
+        os.chmod(stub, 0o755)
+        self.function_path = os.path.join(self.tmp_dir.name, "function.py")
+        with open(self.function_path, "w") as f:
+            f.write("def handler(event):\n    return event['data'] * 2\n")
+        self.script_file = os.path.join(self.tmp_dir.name, "script.bt")
+        path = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        self.env = mock.patch.dict(os.environ, {"PATH": path, "STUB_BPFTRACE_SCRIPT": self.script_file})
+        self.env.start()
+        # A driver that never passes its gate would otherwise hang the suite
+        faulthandler.dump_traceback_later(60, exit=True)
+
+    def tearDown(self):
+        faulthandler.cancel_dump_traceback_later()
+        self.env.stop()
+        self.tmp_dir.cleanup()
+
+    def test_gated_driver_runs_once_under_probe(self):
+        summary_file = os.path.join(self.tmp_dir.name, "summary.txt")
+        full_file = os.path.join(self.tmp_dir.name, "full.txt")
+        completed, error, counts = TrueRuntimeProfiler()._trace_full_python_bpftrace(
+            self.function_path, {"data": "ab"}, summary_file, full_file
+        )
+
+        self.assertEqual(completed.returncode, 0)
+        self.assertEqual(completed.stdout.strip(), "'abab'")
+        self.assertIsNone(error)
+        self.assertEqual(counts, {_syscall_name(0): 2})
+        with open(full_file) as f:
+            pid, trace_line = f.read().split(" ", 1)
+        self.assertTrue(pid.isdigit())
+        self.assertEqual(trace_line, f"{_syscall_name(0)}() = 5\n")
+        with open(self.script_file) as f:
+            self.assertEqual(f.read(), BPFTRACE_SCRIPT)
+
+    def test_summary_only_run_skips_trace_printf(self):
+        summary_file = os.path.join(self.tmp_dir.name, "summary.txt")
+        completed, _, counts = TrueRuntimeProfiler()._trace_full_python_bpftrace(
+            self.function_path, {"data": "ab"}, summary_file, None
+        )
+
+        self.assertEqual(completed.returncode, 0)
+        self.assertEqual(counts, {_syscall_name(0): 2})
+        with open(self.script_file) as f:
+            self.assertNotIn("args->ret);", f.read())
+
+
+class SyscallSummaries(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name, content=None):
+        path = os.path.join(self.tmp_dir.name, name)
+        if content is not None:
+            with open(path, "w") as f:
+                f.write(content)
+        return path
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+    def test_parse_strace_summary(self):
+        summary = TrueRuntimeProfiler().parse_strace_summary(self.path("summary.txt", STRACE_SUMMARY))
+
+        self.assertEqual(list(summary["name"]), ["openat", "read"])
+        self.assertEqual(list(summary["calls"]), [60, 100])
+        # Blank errors column reads as 0; the total row is dropped
+        self.assertEqual(list(summary["errors"]), [2, 0])
+        self.assertAlmostEqual(summary["sec"][0], 0.0006)
+
+    def test_split_bpftrace_output(self):
+        summary_file = self.path("summary.txt")
+        full_file = self.path("full.txt")
+        counts = _split_bpftrace_output(self.path("raw.txt", BPFTRACE_OUTPUT), summary_file, full_file)
+
+        first, second = _syscall_name(0), _syscall_name(1)
+        self.assertEqual(counts, {first: 1, second: 1})
+        with open(full_file) as f:
+            self.assertEqual(f.read(), f"200 {first}() = 5\n200 {second}() = -9\n")
+        with open(summary_file) as f:
+            rows = {row[5]: row for row in SUMMARY_RE.findall(f.read())}
+        # (% time, seconds, usecs/call, calls, errors, syscall), sorted by time
+        self.assertEqual(rows[first][3:5], ("1", ""))
+        self.assertEqual(rows[second][3:5], ("1", "1"))
+        self.assertEqual(rows["total"][3:5], ("2", "1"))
+        self.assertEqual(rows[first][1], "0.000002")
+
+    def test_split_batch_trace(self):
+        outputs = _split_batch_trace(self.path("batch.txt", BATCH_TRACE), ["first", "second"],
+                                     self.tmp_dir.name)
+
+        self.assertEqual(sorted(outputs), ["first", "second"])
+        with open(outputs["first"]) as f:
+            self.assertEqual(f.read(), 'openat(AT_FDCWD, "/first", O_RDONLY) = 3\n')
+        with open(outputs["second"]) as f:
+            self.assertEqual(f.read(), 'read(3, "", 4096) = 0\nwrite(1, "x", 1) = 1\n')
+
+
+class PerfRingTally(unittest.TestCase):
+    PAGE_SIZE = 4096
+    ENTER_ID = 7
+    EXIT_ID = 8
+
+    def sample(self, tid, timestamp, common_type, nr, value):
+        # u32 pid, u32 tid, u64 time, u32 raw size, then the tracepoint record:
+        # u16 common_type, 6 more bytes of common fields, long id, long arg0/ret
+        payload = struct.pack("<IIQIH6xqq", tid, tid, timestamp, 24, common_type, nr, value)
+        return struct.pack("<IHH", PERF_RECORD_SAMPLE, 0, 8 + len(payload)) + payload
+
+    def counter(self, records, tail):
+        """A PerfSyscallCounter over a one-page ring holding records from data_tail on"""
+        counter = PerfSyscallCounter.__new__(PerfSyscallCounter)
+        counter.page_size = self.PAGE_SIZE
+        counter.ring_pages = 1
+        counter.enter_id = self.ENTER_ID
+        counter.lost_samples = 0
+        counter.ring = bytearray(2 * self.PAGE_SIZE)
+        data = b"".join(records)
+        for i, byte in enumerate(data):
+            counter.ring[self.PAGE_SIZE + (tail + i) % self.PAGE_SIZE] = byte
+        struct.pack_into("QQQQ", counter.ring, 1024, tail + len(data), tail, self.PAGE_SIZE,
+                         self.PAGE_SIZE)
+        return counter
+
+    def test_tally_pairs_enter_and_exit(self):
+        records = [
+            self.sample(1, 1000, self.ENTER_ID, 0, 0),
+            self.sample(2, 1100, self.ENTER_ID, 1, 0),
+            self.sample(1, 1500, self.EXIT_ID, 0, -2),
+            self.sample(2, 1700, self.EXIT_ID, 1, 1),
+            struct.pack("<IHHQQ", PERF_RECORD_LOST, 0, 24, 0, 3),
+        ]
+        # Start just before the end of the ring so the first record wraps around
+        counter = self.counter(records, tail=self.PAGE_SIZE - 20)
+
+        stats = counter.tally()
+
+        self.assertEqual(stats, {_syscall_name(0): (1, 1, 500), _syscall_name(1): (1, 0, 600)})
+        self.assertEqual(counter.lost_samples, 3)
+        head, tail = struct.unpack_from("QQ", counter.ring, 1024)
+        self.assertEqual(tail, head)
+
+
+class FullTraceRegex(unittest.TestCase):
+    def tearDown(self):
+        _full_trace_regex.cache_clear()
+
+    def test_google_re2_api_falls_back_to_re(self):
+        def google_compile(pattern, options=None):
+            # google-re2 takes an Options object, not re flags
+            if options is not None and not hasattr(options, "max_mem"):
+                raise TypeError("options must be re2.Options")
+
+        google_re2 = types.ModuleType("re2")
+        google_re2.compile = google_compile
+        _full_trace_regex.cache_clear()
+        with mock.patch.dict(sys.modules, {"re2": google_re2}):
+            regex = _full_trace_regex()
+
+        self.assertIsInstance(regex, re.Pattern)
+        self.assertEqual(regex.findall(b"12 close(3) = 0\n"), [(b"12", b"", b"close", b"3", b"0")])
+
+
+@unittest.skipUnless(importlib.util.find_spec("pandas"), "pandas is not installed")
+class FullTraceParsing(unittest.TestCase):
+    def test_split_calls_counted_once(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as trace:
+            trace.write(SPLIT_TRACE)
+            trace.flush()
+            counts = TrueRuntimeProfiler().parse_full_trace(trace.name)
+
+        self.assertEqual(
+            counts.to_dict(),
+            {"read": 2, "openat": 1, "close": 1, "mmap": 1, "exit_group": 1},
+        )
+
+
+@unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+class RuntimeImportIsolation(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.profiler = TrueRuntimeProfiler()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def function_info(self, name, source):
+        path = os.path.join(self.tmp_dir.name, name, "function.py")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(source)
+        return {"name": name, "function_path": path}
+
+    def test_numpy_functions_back_to_back(self):
+        # Other tests may already have imported numpy into this process
+        numpy_loaded = "numpy" in sys.modules
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        try:
+            results = [
+                self.profiler.profile_function_in_runtime(
+                    self.function_info(name, NUMPY_FUNCTION.format(n)), mode="rusage"
+                )
+                for name, n in [("numpy-first", 3), ("numpy-second", 4)]
+            ]
+        finally:
+            os.chdir(cwd)
+
+        for result, expected in zip(results, [3, 6]):
+            self.assertTrue(result["success"])
+            self.assertIsNone(result["error"])
+            self.assertEqual(result["function_result"], expected)
+        if not numpy_loaded:
+            # numpy stays loaded after the first profile, so the second imports it warm
+            self.assertTrue(results[0]["imports_isolated"])
+            self.assertIn("numpy", results[0]["imports_kept"])
+            self.assertFalse(results[1]["imports_isolated"])
+
+        # The profiler's own lazy numpy imports must still work afterwards
+        import numpy
+
+        self.assertEqual(int(numpy.arange(3).sum()), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
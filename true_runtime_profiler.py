@@ -6,66 +6,793 @@ Focus on profiling function execution within current runtime (Python already loa
 
 import os
 import sys
+import ast
+import argparse
 import subprocess
 import json
 import time
+import importlib
+import importlib.machinery
 import importlib.util
+import pickle
 from pathlib import Path
 import signal
+import resource
+import ctypes
+import fcntl
+import functools
+import mmap
+import platform
+import re
+import shutil
+import struct
+import tempfile
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# perf_event_open(2) plumbing for the in-kernel syscall counter
+PERF_EVENT_OPEN_NR = {'x86_64': 298, 'aarch64': 241}
+PERF_TYPE_TRACEPOINT = 2
+PERF_SAMPLE_TID = 1 << 1
+PERF_SAMPLE_TIME = 1 << 2
+PERF_SAMPLE_RAW = 1 << 10
+PERF_RECORD_LOST = 2
+PERF_RECORD_SAMPLE = 9
+PERF_EVENT_IOC_ENABLE = 0x2400
+PERF_EVENT_IOC_DISABLE = 0x2401
+PERF_EVENT_IOC_SET_OUTPUT = 0x2405
+# Default ring size (data pages, a power of two); 4 MiB holds roughly 20k enter+exit pairs
+PERF_RING_PAGES = 1 << 10
+TRACEFS_DIRS = ['/sys/kernel/tracing', '/sys/kernel/debug/tracing']
+# Function driver for full-python mode, run as python3 -c DRIVER_SCRIPT <function.py> <json input> <error fd>
+DRIVER_SCRIPT = '''
+import importlib.util, json, os, sys
+sys.excepthook = lambda exc_type, exc, tb: os.write(int(sys.argv[3]), str(exc).encode())
+spec = importlib.util.spec_from_file_location("func_module", sys.argv[1])
+func_module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(func_module)
+print(repr(func_module.handler(json.loads(sys.argv[2]))))
+'''
+# Exec gate for bpftrace mode, run as python3 -c GATE_SCRIPT <gate fd> <command...>: blocks until
+# the probes are attached, then execs the driver in the same PID (exits if the gate is closed)
+GATE_SCRIPT = '''
+import os, sys
+gate = int(sys.argv[1])
+if not os.read(gate, 1):
+    sys.exit(1)
+os.close(gate)
+os.execvp(sys.argv[2], sys.argv[2:])
+'''
+# Single-pass syscall histogram + trace of the driver PID ($1) for full-python mode
+BPFTRACE_SCRIPT = r'''
+BEGIN { printf("@trace:\n"); }
+tracepoint:raw_syscalls:sys_enter /pid == $1/ {
+    @cnt[args->id] = count();
+    @start[tid] = nsecs;
+    @nr[tid] = args->id;
+}
+tracepoint:raw_syscalls:sys_exit /pid == $1 && @start[tid]/ {
+    @ns[@nr[tid]] = sum(nsecs - @start[tid]);
+    if (args->ret < 0 && args->ret >= -4095) { @err[@nr[tid]] = count(); }
+    printf("%d %d %d\n", tid, @nr[tid], args->ret);
+    delete(@start[tid]);
+    delete(@nr[tid]);
+}
+END {
+    clear(@start);
+    clear(@nr);
+    print(@cnt);
+    print(@err);
+    print(@ns);
+    clear(@cnt);
+    clear(@err);
+    clear(@ns);
+}
+'''
+# Without keep_raw only the END maps are written, not a line per syscall
+BPFTRACE_TRACE_PRINTF = '    printf("%d %d %d\\n", tid, @nr[tid], args->ret);\n'
+BPFTRACE_SUMMARY_SCRIPT = BPFTRACE_SCRIPT.replace(BPFTRACE_TRACE_PRINTF, '')
+BPFTRACE_MAP_RE = re.compile(r'^@(cnt|err|ns)\[(\d+)\]: (\d+)$')
+BPFTRACE_TRACE_RE = re.compile(r'^(\d+) (\d+) (-?\d+)$')
+# Syscall classes kept in attached line-level strace output (runtime full trace, batch);
+# skips futex/mmap/rt_sig* noise. Full-python runs are unfiltered: their -C summary shares the run
+STRACE_TRACE_FILTER = 'trace=%file,%desc,%network,%process'
+# Syscall name of a strace output line, with or without the -f PID prefix
+STRACE_LINE_RE = re.compile(rb'^(?:\d+\s+)?(\w+)\(')
+# Completed call in a full strace file: optional -f PID, optional timestamp, syscall, args, return.
+# A call split by -f is matched on its "<... name resumed>" line only, so it is counted once
+FULL_TRACE_PATTERN = (rb'^(?:(\d+)\s+)?(?:([\d.:]+)\s+)?(?:<\.\.\. )?(\w+)(?:\(| resumed>)(.*?)\)\s*=\s*'
+                      rb'(0x[\da-f]+|-?\d+|\?)')
+FULL_TRACE_COLUMNS = ['pid', 'timestamp', 'syscall', 'args', 'ret']
+# One row of an strace -c summary table: % time, seconds, usecs/call, calls, errors, syscall
+SUMMARY_RE = re.compile(r'^\s*([\d.]+)\s+([\d.]+)\s+(\d+)\s+(\d+)\s*(\d*)\s+(\w+)$', re.M)
+# errors is blank for syscalls that never failed, so it is matched as text and converted after
+SUMMARY_RAW_DTYPE = [('pct', 'f8'), ('sec', 'f8'), ('us', 'i8'), ('calls', 'i8'), ('errors', 'U20'),
+                     ('name', 'U32')]
+SUMMARY_DTYPE = [('pct', 'f8'), ('sec', 'f8'), ('us', 'i8'), ('calls', 'i8'), ('errors', 'i8'),
+                 ('name', 'U32')]
+# profile_function_in_runtime modes -> profiling_mode suffix
+RUNTIME_MODES = {'summary': 'summary', 'strace-full': 'full', 'rusage': 'rusage'}
+# getrusage(RUSAGE_SELF) fields reported by the rusage runtime mode
+RUSAGE_FIELDS = ['ru_utime', 'ru_stime', 'ru_minflt', 'ru_majflt', 'ru_nvcsw', 'ru_nivcsw',
+                 'ru_inblock', 'ru_oublock']
+# Benchmark dependencies imported once by the warm template process
+TEMPLATE_PRELOAD = ['PIL', 'numpy', 'nltk', 'boto3']
+# Batched summary loading: ring size and per-file read buffer
+IO_URING_ENTRIES = 64
+SUMMARY_READ_SIZE = 64 * 1024
+# Benchmark subdirectories that never contain Python functions
+DISCOVERY_SKIP_DIRS = {'node.js', 'nodejs', 'input'}
+# prctl(PR_SET_NAME) markers delimiting each function in a batch strace
+PR_SET_NAME = 15
+PR_GET_NAME = 16
+# prctl(PR_SET_PTRACER) lets a non-ancestor (the attached strace) trace us under Yama ptrace_scope=1
+PR_SET_PTRACER = 0x59616d61
+PR_SET_PTRACER_ANY = ctypes.c_ulong(-1).value
+YAMA_PTRACE_SCOPE = '/proc/sys/kernel/yama/ptrace_scope'
+PTRACE_SCOPE_HINT = 'run `sudo sysctl kernel.yama.ptrace_scope=0` to let strace attach to the profiler'
+BATCH_MARKER_RE = re.compile(r'prctl\(PR_SET_NAME, "PROF_(BEG|END):(\d+)"')
+SYSCALL_HEADERS = [
+    '/usr/include/x86_64-linux-gnu/asm/unistd_64.h',
+    '/usr/include/asm/unistd_64.h',
+    '/usr/include/asm-generic/unistd.h',
+]
+
+
+class PerfEventAttr(ctypes.Structure):
+    """struct perf_event_attr (PERF_ATTR_SIZE_VER5)"""
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('size', ctypes.c_uint32),
+        ('config', ctypes.c_uint64),
+        ('sample_period', ctypes.c_uint64),
+        ('sample_type', ctypes.c_uint64),
+        ('read_format', ctypes.c_uint64),
+        ('flags', ctypes.c_uint64),
+        ('wakeup_events', ctypes.c_uint32),
+        ('bp_type', ctypes.c_uint32),
+        ('config1', ctypes.c_uint64),
+        ('config2', ctypes.c_uint64),
+        ('branch_sample_type', ctypes.c_uint64),
+        ('sample_regs_user', ctypes.c_uint64),
+        ('sample_stack_user', ctypes.c_uint32),
+        ('clockid', ctypes.c_int32),
+        ('sample_regs_intr', ctypes.c_uint64),
+        ('aux_watermark', ctypes.c_uint32),
+        ('sample_max_stack', ctypes.c_uint16),
+        ('reserved_2', ctypes.c_uint16),
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _syscall_names():
+    """Map syscall numbers to names using the kernel uapi headers"""
+    names = {}
+    for header in SYSCALL_HEADERS:
+        try:
+            with open(header) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[0] == '#define' and parts[1].startswith('__NR_') \
+                            and parts[2].isdigit():
+                        names[int(parts[2])] = parts[1][len('__NR_'):]
+        except OSError:
+            continue
+        if names:
+            break
+    return names
+
+
+def _syscall_name(nr):
+    return _syscall_names().get(nr, f'syscall_{nr}')
+
+
+def _set_thread_name(name):
+    """Set the calling thread's name with prctl(PR_SET_NAME), returning the previous one"""
+    libc = ctypes.CDLL(None, use_errno=True)
+    previous = ctypes.create_string_buffer(16)
+    libc.prctl(PR_GET_NAME, previous, 0, 0, 0)
+    libc.prctl(PR_SET_NAME, name.encode()[:15], 0, 0, 0)
+    return previous.value.decode(errors='replace')
+
+
+def _allow_any_ptracer():
+    """Opt this process in to being traced by any process (Yama PR_SET_PTRACER_ANY)
+    
+    Returns None when an attached strace can trace us, otherwise PTRACE_SCOPE_HINT.
+    The setting is per task and not inherited, so forked processes call this again.
+    """
+    try:
+        with open(YAMA_PTRACE_SCOPE) as f:
+            scope = int(f.read())
+    except (OSError, ValueError):
+        # No Yama LSM: ordinary ptrace permission checks only
+        return None
+    if scope == 0:
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+    if scope == 1 and libc.prctl(PR_SET_PTRACER, ctypes.c_ulong(PR_SET_PTRACER_ANY), 0, 0, 0) == 0:
+        return None
+    # Scope 2 (admin-only) and 3 (no attach) ignore the opt-in
+    print(f"Warning: ptrace_scope={scope} and PR_SET_PTRACER did not help; {PTRACE_SCOPE_HINT}")
+    return PTRACE_SCOPE_HINT
+
+
+def _tracepoint_id(event):
+    """Read the tracepoint id of e.g. 'raw_syscalls/sys_enter' from tracefs"""
+    for tracefs in TRACEFS_DIRS:
+        try:
+            with open(os.path.join(tracefs, 'events', event, 'id')) as f:
+                return int(f.read().strip())
+        except OSError:
+            continue
+    raise OSError(f"Tracepoint {event} not found in {', '.join(TRACEFS_DIRS)}")
+
+
+def _write_syscall_summary(path, stats):
+    """Write per-syscall {name: (calls, errors, nanoseconds)} stats in strace -c format"""
+    total_ns = sum(ns for _, _, ns in stats.values())
+    total_calls = sum(calls for calls, _, _ in stats.values())
+    total_errors = sum(errors for _, errors, _ in stats.values())
+    separator = '------ ----------- ----------- --------- --------- ----------------\n'
+
+    def row(pct, ns, calls, errors, name):
+        usecs = ns // 1000 // calls if calls else 0
+        errors = str(errors) if errors else ''
+        return f"{pct:6.2f} {ns / 1e9:11.6f} {usecs:11d} {calls:9d} {errors:>9} {name}\n"
+
+    with open(path, 'w') as f:
+        f.write('% time     seconds  usecs/call     calls    errors syscall\n')
+        f.write(separator)
+        for name, (calls, errors, ns) in sorted(stats.items(), key=lambda kv: (-kv[1][2], -kv[1][0])):
+            pct = 100.0 * ns / total_ns if total_ns else 0.0
+            f.write(row(pct, ns, calls, errors, name))
+        f.write(separator)
+        f.write(row(100.0, total_ns, total_calls, total_errors, 'total'))
+
+
+def _split_bpftrace_output(raw_file, summary_file, full_file=None):
+    """Split BPFTRACE_SCRIPT output into an strace -c style summary and (optionally) a trace
+    
+    Returns the per-syscall call counts.
+    """
+    stats = {}
+    full = open(full_file, 'w') if full_file else None
+    with open(raw_file) as raw:
+        for line in raw:
+            line = line.strip()
+            match = BPFTRACE_MAP_RE.match(line)
+            if match:
+                name = _syscall_name(int(match.group(2)))
+                calls, errors, ns = stats.get(name, (0, 0, 0))
+                value = int(match.group(3))
+                if match.group(1) == 'cnt':
+                    calls = value
+                elif match.group(1) == 'err':
+                    errors = value
+                else:
+                    ns = value
+                stats[name] = (calls, errors, ns)
+                continue
+            match = BPFTRACE_TRACE_RE.match(line) if full else None
+            if match:
+                tid, nr, ret = match.groups()
+                full.write(f"{tid} {_syscall_name(int(nr))}() = {ret}\n")
+    if full:
+        full.close()
+    _write_syscall_summary(summary_file, stats)
+    return Counter({name: calls for name, (calls, _, _) in stats.items()})
+
+
+@functools.lru_cache(maxsize=None)
+def _full_trace_regex():
+    """FULL_TRACE_PATTERN compiled with RE2 (pip install pyre2) when available, else with re
+    
+    google-re2 installs a re2 module too, with compile(pattern, options); any re2 that does
+    not take re flags and find the same rows in an mmap as re does is not used.
+    """
+    fallback = re.compile(FULL_TRACE_PATTERN, re.M)
+    try:
+        import re2
+        compiled = re2.compile(FULL_TRACE_PATTERN, re.M)
+        probe_line = b'1 read(3, "", 1) = 0\n'
+        with mmap.mmap(-1, 2 * len(probe_line)) as probe:
+            probe.write(2 * probe_line)
+            if compiled.findall(probe) == fallback.findall(probe):
+                return compiled
+    except Exception:
+        pass
+    return fallback
+
+
+def _split_batch_trace(batch_file, names, output_dir):
+    """Split a batch strace at its PROF_BEG/PROF_END markers into runtime_full_<name>.txt files
+    
+    Marker i belongs to names[i]; returns {name: path}.
+    """
+    outputs = {}
+    current = None
+    with open(batch_file) as batch:
+        for line in batch:
+            match = BATCH_MARKER_RE.search(line)
+            if match:
+                name = names[int(match.group(2))]
+                if match.group(1) == 'BEG':
+                    current = open(os.path.join(output_dir, f"runtime_full_{name}.txt"), 'w')
+                    outputs[name] = current.name
+                elif current:
+                    current.close()
+                    current = None
+            elif current:
+                current.write(line)
+    if current:
+        current.close()
+    return outputs
+
+
+def _snapshot_imports():
+    """Checkpoint sys.modules and sys.path before running a function in this process"""
+    return set(sys.modules), list(sys.path)
+
+
+def _is_extension_module(module):
+    origin = getattr(getattr(module, '__spec__', None), 'origin', None) or ''
+    return origin.endswith(tuple(importlib.machinery.EXTENSION_SUFFIXES))
+
+
+def _restore_imports(snapshot):
+    """Drop modules imported since the checkpoint and restore sys.path
+    
+    Later functions then import their dependencies again instead of finding them cached.
+    Packages that loaded a C extension stay imported: most extensions cannot be
+    initialised a second time in one process. Returns the names of those packages.
+    """
+    saved_modules, saved_path = snapshot
+    new_modules = [name for name in sys.modules if name not in saved_modules]
+    pinned = {name.partition('.')[0] for name in new_modules if _is_extension_module(sys.modules[name])}
+    for name in new_modules:
+        if name.partition('.')[0] not in pinned:
+            del sys.modules[name]
+    sys.path[:] = saved_path
+    return pinned
+
+
+def _write_rusage_summary(path, before, after, wall_ns):
+    """Write the getrusage deltas of a profiled section; returns them as a dict"""
+    delta = {field: getattr(after, field) - getattr(before, field) for field in RUSAGE_FIELDS}
+    delta['wall_ns'] = wall_ns
+    with open(path, 'w') as f:
+        for field, value in delta.items():
+            f.write(f"{field:<12} {value:.6f}\n" if isinstance(value, float) else f"{field:<12} {value}\n")
+    return delta
+
+
+def _summary_array(raw):
+    """Convert a SUMMARY_RAW_DTYPE array into SUMMARY_DTYPE, dropping the total row"""
+    import numpy as np
+    
+    raw = raw[raw['name'] != 'total']
+    summary = np.empty(len(raw), dtype=SUMMARY_DTYPE)
+    for field in ('pct', 'sec', 'us', 'calls', 'name'):
+        summary[field] = raw[field]
+    summary['errors'] = np.where(raw['errors'] == '', '0', raw['errors']).astype('i8')
+    return summary
+
+
+def _read_files_io_uring(paths):
+    """Read whole files with io_uring: each chunk of opens, reads and closes is one submission
+    
+    Raises ImportError without the liburing binding and OSError when io_uring or a file fails.
+    """
+    from liburing import (AT_FDCWD, Cqe, OpenHow, Ring, io_uring_cq_advance, io_uring_cq_ready,
+                          io_uring_get_sqe, io_uring_prep_close, io_uring_prep_openat2,
+                          io_uring_prep_read, io_uring_queue_exit, io_uring_queue_init,
+                          io_uring_submit_and_wait, io_uring_wait_cqe)
+    
+    def submit(ring, cqe, preps):
+        """Queue one SQE per prep callable, submit them together and return results in order"""
+        if not preps:
+            return []
+        for index, prep in enumerate(preps):
+            sqe = io_uring_get_sqe(ring)
+            prep(sqe)
+            sqe.user_data = index
+        io_uring_submit_and_wait(ring, len(preps))
+        io_uring_wait_cqe(ring, cqe)
+        ready = io_uring_cq_ready(ring)
+        results = [None] * len(preps)
+        try:
+            for i in range(ready):
+                entry = cqe[i]
+                index = entry.user_data
+                try:
+                    results[index] = entry.res
+                except OSError as e:
+                    results[index] = e
+        finally:
+            io_uring_cq_advance(ring, ready)
+        return results
+    
+    how = OpenHow()
+    how.flags = os.O_RDONLY | os.O_CLOEXEC
+    ring = Ring()
+    cqe = Cqe()
+    io_uring_queue_init(IO_URING_ENTRIES, ring)
+    contents = {}
+    try:
+        for start in range(0, len(paths), IO_URING_ENTRIES):
+            batch = paths[start:start + IO_URING_ENTRIES]
+            fds = submit(ring, cqe, [
+                lambda sqe, path=path: io_uring_prep_openat2(sqe, path, how, dfd=AT_FDCWD)
+                for path in batch
+            ])
+            opened = [fd for fd in fds if isinstance(fd, int)]
+            try:
+                errors = [fd for fd in fds if not isinstance(fd, int)]
+                if errors:
+                    raise errors[0]
+                buffers = [bytearray(SUMMARY_READ_SIZE) for _ in batch]
+                sizes = submit(ring, cqe, [
+                    lambda sqe, fd=fd, buf=buf: io_uring_prep_read(sqe, fd, buf, 0)
+                    for fd, buf in zip(fds, buffers)
+                ])
+                for path, fd, buf, size in zip(batch, fds, buffers, sizes):
+                    if isinstance(size, OSError):
+                        raise size
+                    data = bytes(buf[:size])
+                    # Rare summaries larger than one buffer: read the rest directly
+                    while size == SUMMARY_READ_SIZE:
+                        chunk = os.pread(fd, SUMMARY_READ_SIZE, len(data))
+                        size = len(chunk)
+                        data += chunk
+                    contents[path] = data
+            finally:
+                submit(ring, cqe, [lambda sqe, fd=fd: io_uring_prep_close(sqe, fd) for fd in opened])
+    finally:
+        io_uring_queue_exit(ring)
+    return contents
+
+
+def _aggregate_strace_stream(fifo_path, raw_path, conn):
+    """Count syscalls in strace output read from fifo_path; sends (Counter, -c summary text)"""
+    counts = Counter()
+    summary = []
+    raw = open(raw_path, 'wb') if raw_path else None
+    try:
+        with open(fifo_path, 'rb', buffering=1 << 20) as fifo:
+            for line in fifo:
+                # strace -c/-C appends its summary table at the end of the output
+                if summary or line.startswith(b'% time'):
+                    summary.append(line.decode(errors='replace'))
+                    continue
+                if raw:
+                    raw.write(line)
+                match = STRACE_LINE_RE.match(line)
+                if match:
+                    counts[match.group(1).decode()] += 1
+    finally:
+        if raw:
+            raw.close()
+    conn.send((counts, ''.join(summary)))
+    conn.close()
+
+
+class StraceFifo:
+    """FIFO used as strace -o target, aggregated in memory instead of written to disk
+    
+    The reader is a forked process rather than a thread: strace may stop this process while
+    it holds the GIL, and a reader thread that cannot run would leave strace blocked on the pipe.
+    """
+
+    def __init__(self, raw_path=None):
+        self._dir = tempfile.mkdtemp(prefix='strace_')
+        self.path = os.path.join(self._dir, f"strace_{os.getpid()}.fifo")
+        os.mkfifo(self.path)
+        ctx = multiprocessing.get_context('fork')
+        self._conn, child_conn = ctx.Pipe(duplex=False)
+        self._reader = ctx.Process(
+            target=_aggregate_strace_stream, args=(self.path, raw_path, child_conn), daemon=True
+        )
+        self._reader.start()
+        child_conn.close()
+
+    def collect(self, timeout=10):
+        """Return (syscall Counter, summary table text) once strace has closed the FIFO"""
+        deadline = time.monotonic() + timeout
+        while not self._conn.poll(0.01):
+            if time.monotonic() >= deadline:
+                raise RuntimeError('strace output reader did not finish')
+            # Unblock the reader if strace never opened the FIFO (ENXIO: reader not in open())
+            try:
+                os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        return self._conn.recv()
+
+    def close(self):
+        if self._reader.is_alive():
+            self._reader.terminate()
+        self._reader.join()
+        self._conn.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class PerfSyscallCounter:
+    """raw_syscalls:sys_enter/sys_exit tracepoints sampled into a shared mmap'd ring buffer"""
+
+    def __init__(self, pid, ring_pages=PERF_RING_PAGES):
+        self.fds = []
+        self.ring = None
+        self.ring_pages = ring_pages
+        # Samples the kernel dropped because the ring was full, set by tally()
+        self.lost_samples = 0
+        self.enter_id = _tracepoint_id('raw_syscalls/sys_enter')
+        exit_id = _tracepoint_id('raw_syscalls/sys_exit')
+        try:
+            enter_fd = self._open(pid, self.enter_id)
+            exit_fd = self._open(pid, exit_id)
+            self.page_size = mmap.PAGESIZE
+            self.ring = mmap.mmap(enter_fd, (1 + ring_pages) * self.page_size,
+                                  mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            # Both tracepoints write into one ring so enter/exit records stay ordered
+            fcntl.ioctl(exit_fd, PERF_EVENT_IOC_SET_OUTPUT, enter_fd)
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self, pid, config):
+        nr = PERF_EVENT_OPEN_NR.get(platform.machine())
+        if nr is None:
+            raise OSError(f"perf_event_open syscall number unknown for {platform.machine()}")
+        attr = PerfEventAttr()
+        attr.type = PERF_TYPE_TRACEPOINT
+        attr.size = ctypes.sizeof(PerfEventAttr)
+        attr.config = config
+        attr.sample_period = 1
+        attr.sample_type = PERF_SAMPLE_TID | PERF_SAMPLE_TIME | PERF_SAMPLE_RAW
+        attr.flags = 1  # disabled
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.syscall(ctypes.c_long(nr), ctypes.byref(attr), ctypes.c_int(pid),
+                          ctypes.c_int(-1), ctypes.c_int(-1), ctypes.c_ulong(0))
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"perf_event_open failed: {os.strerror(errno)}")
+        self.fds.append(fd)
+        return fd
+
+    def enable(self):
+        for fd in self.fds:
+            fcntl.ioctl(fd, PERF_EVENT_IOC_ENABLE, 0)
+
+    def disable(self):
+        for fd in self.fds:
+            fcntl.ioctl(fd, PERF_EVENT_IOC_DISABLE, 0)
+
+    def _records(self):
+        """Yield (type, payload) for every record in the ring buffer"""
+        data_head, data_tail, data_offset, data_size = struct.unpack_from('QQQQ', self.ring, 1024)
+        if not data_size:
+            data_offset, data_size = self.page_size, self.ring_pages * self.page_size
+
+        def read(pos, length):
+            start = data_offset + pos % data_size
+            end = start + length
+            if end <= data_offset + data_size:
+                return self.ring[start:end]
+            wrap = end - (data_offset + data_size)
+            return self.ring[start:data_offset + data_size] + self.ring[data_offset:data_offset + wrap]
+
+        pos = data_tail
+        while pos + 8 <= data_head:
+            rec_type, _, rec_size = struct.unpack('IHH', read(pos, 8))
+            if rec_size < 8:
+                break
+            yield rec_type, read(pos + 8, rec_size - 8)
+            pos += rec_size
+        struct.pack_into('Q', self.ring, 1032, pos)
+
+    def tally(self):
+        """Per-syscall {name: (calls, errors, nanoseconds)} from the collected samples"""
+        stats = {}
+        pending = {}
+        lost = 0
+        for rec_type, payload in self._records():
+            if rec_type == PERF_RECORD_LOST:
+                lost += struct.unpack_from('QQ', payload)[1]
+                continue
+            if rec_type != PERF_RECORD_SAMPLE:
+                continue
+            # u32 pid, u32 tid, u64 time, u32 raw size, raw tracepoint data:
+            # common fields (8 bytes), long id, then args[6] (sys_enter) or long ret (sys_exit)
+            _, tid, timestamp, _ = struct.unpack_from('IIQI', payload)
+            common_type, = struct.unpack_from('H', payload, 20)
+            nr, value = struct.unpack_from('qq', payload, 28)
+            if common_type == self.enter_id:
+                name = _syscall_name(nr)
+                calls, errors, ns = stats.get(name, (0, 0, 0))
+                stats[name] = (calls + 1, errors, ns)
+                pending[tid] = (name, timestamp)
+            elif tid in pending:
+                name, started = pending.pop(tid)
+                calls, errors, ns = stats[name]
+                stats[name] = (calls, errors + (-4095 <= value < 0), ns + timestamp - started)
+        self.lost_samples = lost
+        if lost:
+            print(f"Warning: perf ring buffer dropped {lost} syscall samples")
+        return stats
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+# Correct input data for different functions
+CORRECT_INPUTS = {
+    # Only this 110. works for now... Not a best way to set up the environment.
+    '110.dynamic-html': {'username': 'testuser', 'random_len': 10},
+    '130.crud-api': {'action': 'get', 'id': '1'},
+    '210.thumbnailer': {'image': 'test.jpg', 'size': 100},
+    '220.video-processing': {'video': 'test.mp4'},
+    '311.compression': {'text': 'Hello World'},
+    '411.image-recognition': {'image': 'test.jpg'},
+    '503.graph-bfs': {'size': 10},
+    '501.graph-pagerank': {'size': 10},
+    '504.dna-visualisation': {'sequence': 'ATCGATCG'},
+    '502.graph-mst': {'size': 10},
+    '020.network-benchmark': {'port': 8080},
+    '030.clock-synchronization': {'time': '12:00:00'},
+    '040.server-reply': {'message': 'hello'},
+    '010.sleep': {'sleep_time': 1},
+    '120.uploader': {'file': 'test.txt', 'content': 'hello world'}
+}
+
 
 class TrueRuntimeProfiler:
     def __init__(self):
         self.functions = self._discover_functions()
+        # Attached strace (-p) is not our ancestor, so Yama ptrace_scope=1 needs an opt-in
+        self._ptrace_hint = _allow_any_ptracer()
+        # function_path -> (mtime, loaded module) for repeated runtime profiling
+        self._module_cache = {}
+        # Packages left imported by _restore_imports; later profiles import them warm
+        self._imports_kept = set()
+        # Warm template process (process, connection) and the modules it preloads
+        self._template = None
+        self._template_preload = list(TEMPLATE_PRELOAD)
+        # perf ring buffer data pages; raise it for functions that overflow the default
+        self.perf_ring_pages = PERF_RING_PAGES
         # Correct input data for different functions
-        self.correct_inputs = {
-            # Only this 110. works for now... Not a best way to set up the environment.
-            '110.dynamic-html': {'username': 'testuser', 'random_len': 10},
-            '130.crud-api': {'action': 'get', 'id': '1'},
-            '210.thumbnailer': {'image': 'test.jpg', 'size': 100},
-            '220.video-processing': {'video': 'test.mp4'},
-            '311.compression': {'text': 'Hello World'},
-            '411.image-recognition': {'image': 'test.jpg'},
-            '503.graph-bfs': {'size': 10},
-            '501.graph-pagerank': {'size': 10},
-            '504.dna-visualisation': {'sequence': 'ATCGATCG'},
-            '502.graph-mst': {'size': 10},
-            '020.network-benchmark': {'port': 8080},
-            '030.clock-synchronization': {'time': '12:00:00'},
-            '040.server-reply': {'message': 'hello'},
-            '010.sleep': {'sleep_time': 1},
-            '120.uploader': {'file': 'test.txt', 'content': 'hello world'}
-        }
+        self.correct_inputs = CORRECT_INPUTS
     
     def _discover_functions(self):
         """Discover all Python functions in the benchmarks directory"""
         functions = []
-        benchmarks_dir = Path("benchmarks")
-        
-        for function_py in benchmarks_dir.rglob("*/python/function.py"):
-            parts = function_py.parts
-            if len(parts) >= 4:
-                category = parts[1]
-                name = parts[2]
-                functions.append({
-                    'name': name,
-                    'category': category,
-                    'function_path': str(function_py),
-                    'input_path': str(function_py.parent / 'input.py')
-                })
-        
-        return functions
+        benchmarks_dir = "benchmarks"
+        
+        # Walk benchmarks/<category>/<name>/python/function.py with scandir; is_dir() uses the
+        # d_type returned by getdents64, so no per-entry stat() as with rglob
+        stack = [(benchmarks_dir, 0)]
+        while stack:
+            path, depth = stack.pop()
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.') or entry.name in DISCOVERY_SKIP_DIRS:
+                    continue
+                if depth == 3:
+                    if entry.name == 'function.py' and entry.is_file(follow_symlinks=False):
+                        function_py = Path(entry.path)
+                        parts = function_py.parts
+                        functions.append({
+                            'name': parts[2],
+                            'category': parts[1],
+                            'function_path': str(function_py),
+                            'input_path': str(function_py.parent / 'input.py')
+                        })
+                elif entry.is_dir(follow_symlinks=False) and (depth < 2 or entry.name == 'python'):
+                    stack.append((entry.path, depth + 1))
+        
+        return sorted(functions, key=lambda f: f['function_path'])
     
     def _get_input_for_function(self, function_name):
         """Get correct input data for a specific function"""
         return self.correct_inputs.get(function_name, {'data': 'test'})
     
-    def profile_function_in_runtime(self, function_info, summary=True):
-        """Profile function loading and execution within current runtime (Python already loaded)"""
+    def _load_function_module(self, function_path):
+        """Load a function module, reusing the cached one while the file is unchanged
+        
+        Returns (module, cache_hit). Set PROFILER_NO_CACHE=1 to always reload (cold start).
+        """
+        mtime = os.stat(function_path).st_mtime
+        cached = self._module_cache.get(function_path)
+        if cached and cached[0] == mtime and os.environ.get('PROFILER_NO_CACHE') != '1':
+            return cached[1], True
+        
+        spec = importlib.util.spec_from_file_location("func_module", function_path)
+        func_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(func_module)
+        self._module_cache[function_path] = (mtime, func_module)
+        return func_module, False
+
+    def _wait_for_tracer(self, tracer_proc=None, timeout=1.0):
+        """Wait until a ptrace tracer is attached to this process (TracerPid in /proc/self/status)
+        
+        Returns False if the tracer exited or timeout (the old fixed sleep) expired first.
+        """
+        deadline = time.monotonic() + timeout
+        # procfs files cannot be mmap'd; keep one fd open and pread() it instead of re-opening
+        fd = os.open('/proc/self/status', os.O_RDONLY)
+        try:
+            while True:
+                status = os.pread(fd, 4096, 0)
+                start = status.find(b'TracerPid:\t')
+                if start >= 0:
+                    tracer_pid = status[start + len(b'TracerPid:\t'):status.find(b'\n', start)]
+                    if tracer_pid.strip() not in (b'', b'0'):
+                        return True
+                if (tracer_proc and tracer_proc.poll() is not None) or time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.0002)
+        finally:
+            os.close(fd)
+
+    def _require_tracer(self, tracer_proc):
+        """_wait_for_tracer, but stop the tracer and raise RuntimeError when it did not attach"""
+        if self._wait_for_tracer(tracer_proc):
+            return
+        exited = tracer_proc.poll() is not None
+        self._stop_tracer(tracer_proc)
+        detail = f"exited with code {tracer_proc.returncode}" if exited else "timed out"
+        if exited and tracer_proc.stderr:
+            detail = tracer_proc.stderr.read().decode(errors='replace').strip() or detail
+        raise RuntimeError(f"strace did not attach to pid {os.getpid()} ({detail}); "
+                           f"if ptrace is restricted, {PTRACE_SCOPE_HINT}")
+
+    def _stop_tracer(self, strace_proc):
+        """Detach an attached strace (started with -I 1) and reap it; no-op once it has exited"""
+        if strace_proc.poll() is not None:
+            return
+        try:
+            strace_proc.send_signal(signal.SIGTERM)
+            strace_proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            strace_proc.kill()
+            strace_proc.wait(timeout=0.5)
+
+    def _start_perf_syscall_counter(self, pid):
+        """Attach a disabled in-kernel syscall counter to pid (raises OSError when unavailable)"""
+        return PerfSyscallCounter(pid, self.perf_ring_pages)
+
+    def profile_function_in_runtime(self, function_info, summary=True, keep_raw=False, mode=None,
+                                    keep_imports=False):
+        """Profile function loading and execution within current runtime (Python already loaded)
+        
+        mode is one of RUNTIME_MODES and defaults to 'summary' or 'strace-full' depending on
+        summary. 'summary' counts syscalls (perf, or strace -c), 'rusage' only diffs getrusage()
+        around the section (no tracer at all), and 'strace-full' keeps a line-level strace.
+        The full trace is aggregated into per-syscall counts (strace_summary); pass
+        keep_raw=True to also keep the raw strace output in strace_file.
+        Modules the function imports are removed from sys.modules afterwards so the next
+        profiled function imports its own; keep_imports=True keeps them (warm measurement).
+        Packages with C extensions cannot be removed; they are listed in imports_kept, and
+        imports_isolated is False once earlier profiles have left any of them loaded.
+        """
         function_path = function_info['function_path']
         function_name = function_info['name']
         input_data = self._get_input_for_function(function_name)
         
-        mode_str = "summary" if summary else "full"
+        if mode is None:
+            mode = 'summary' if summary else 'strace-full'
+        if mode not in RUNTIME_MODES:
+            raise ValueError(f"Unknown runtime profiling mode {mode}, expected one of {list(RUNTIME_MODES)}")
+        mode_str = RUNTIME_MODES[mode]
         print(f"=== Profiling {function_name} in current runtime ({mode_str}) ===")
         print(f"Function path: {function_path}")
         print(f"Input data: {input_data}")
@@ -74,59 +801,117 @@ class TrueRuntimeProfiler:
         current_pid = os.getpid()
         
         # Create output file for strace results with different names
-        if summary:
+        if mode == 'summary':
             strace_file = f"runtime_summary_{function_name}.txt"
-            strace_cmd = ['strace', '-c', '-p', str(current_pid), '-o', strace_file]
-        else:
+            trace_filter = None
+            strace_cmd = ['strace', '-I', '1', '-c', '-p', str(current_pid), '-o', strace_file]
+        elif mode == 'strace-full':
             strace_file = f"runtime_full_{function_name}.txt"
-            strace_cmd = ['strace', '-p', str(current_pid), '-o', strace_file]
+            trace_filter = STRACE_TRACE_FILTER
+        else:
+            strace_file = f"runtime_rusage_{function_name}.txt"
+            trace_filter = None
         
+        perf_counter = None
+        strace_fifo = None
         strace_proc = None
         try:
-            # Start strace
-            strace_proc = subprocess.Popen(
-                strace_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
+            # Summary counts are gathered in-kernel; line-level traces still need strace
+            if mode == 'summary':
+                try:
+                    perf_counter = self._start_perf_syscall_counter(current_pid)
+                except OSError as e:
+                    print(f"perf_event_open unavailable ({e}), falling back to strace")
+            elif mode == 'strace-full':
+                # Stream the trace through a FIFO and aggregate it instead of writing it to disk
+                strace_fifo = StraceFifo(strace_file if keep_raw else None)
+                strace_cmd = ['strace', '-I', '1', '-p', str(current_pid), '-e', trace_filter,
+                              '-o', strace_fifo.path]
             
-            # Wait for strace to attach to the process
-            time.sleep(1)
+            if perf_counter is None and mode != 'rusage':
+                # Start strace
+                strace_proc = subprocess.Popen(
+                    strace_cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+                
+                # Wait for strace to attach to the process; an untraced run is not a profile
+                self._require_tracer(strace_proc)
             
             # === Start of profiled section: function loading and execution ===
             function_result = None
             error_msg = None
+            module_cache_hit = False
             
+            imports = None if keep_imports else _snapshot_imports()
+            warm_imports = bool(self._imports_kept)
+            if perf_counter:
+                perf_counter.enable()
+            # Only rusage mode reads the clock/rusage: under perf or strace they would be counted
+            if mode == 'rusage':
+                started_ns = time.perf_counter_ns()
+                usage_before = resource.getrusage(resource.RUSAGE_SELF)
             try:
                 # Load function module
-                spec = importlib.util.spec_from_file_location("func_module", function_path)
-                func_module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(func_module)
+                func_module, module_cache_hit = self._load_function_module(function_path)
                 
                 # Execute function
                 function_result = func_module.handler(input_data)
                     
             except Exception as e:
                 error_msg = str(e)
+            finally:
+                if mode == 'rusage':
+                    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+                    wall_ns = time.perf_counter_ns() - started_ns
+                if perf_counter:
+                    perf_counter.disable()
+                if imports:
+                    self._imports_kept |= _restore_imports(imports)
             
             # === End of profiled section ===
             
+            if perf_counter:
+                syscall_stats = perf_counter.tally()
+                # Dropped samples mean truncated counts, so no summary is written for them
+                if not perf_counter.lost_samples:
+                    _write_syscall_summary(strace_file, syscall_stats)
+            
             # Stop strace process
             if strace_proc:
-                strace_proc.send_signal(signal.SIGINT)
-                strace_proc.wait(timeout=10)
+                self._stop_tracer(strace_proc)
             
-            print(f"Runtime strace file saved: {strace_file}")
-            
-            return {
+            result = {
                 'function_name': function_name,
                 'profiling_mode': f'runtime_{mode_str}',
                 'success': True,
                 'function_result': function_result,
                 'error': error_msg,
                 'input_data': input_data,
-                'strace_file': strace_file
+                'syscall_backend': 'perf' if perf_counter else 'rusage' if mode == 'rusage' else 'strace',
+                'trace_filter': trace_filter,
+                'module_cache_hit': module_cache_hit,
+                'imports_isolated': not keep_imports and not warm_imports,
+                'imports_kept': sorted(self._imports_kept)
             }
+            if strace_proc and self._ptrace_hint:
+                result['ptrace_hint'] = self._ptrace_hint
+            if perf_counter:
+                result['perf_lost_samples'] = perf_counter.lost_samples
+                if perf_counter.lost_samples:
+                    result['success'] = False
+                    result['error'] = (f"perf ring buffer dropped {perf_counter.lost_samples} syscall "
+                                       f"samples; raise perf_ring_pages (now {self.perf_ring_pages})")
+                    return result
+            if mode == 'rusage':
+                result['rusage'] = _write_rusage_summary(strace_file, usage_before, usage_after, wall_ns)
+            if strace_fifo:
+                result['strace_summary'], _ = strace_fifo.collect()
+            if mode != 'strace-full' or keep_raw:
+                print(f"Runtime strace file saved: {strace_file}")
+                result['strace_file'] = strace_file
+            return result
             
         except Exception as e:
             return {
@@ -138,117 +923,512 @@ class TrueRuntimeProfiler:
             }
         finally:
             # Cleanup
-            if strace_proc and strace_proc.poll() is None:
+            if perf_counter:
+                perf_counter.close()
+            if strace_proc:
+                self._stop_tracer(strace_proc)
+            if strace_fifo:
+                strace_fifo.close()
+
+    def start_batch_profiling(self, output_dir):
+        """Attach a single strace to this process for a batch of runtime profiles"""
+        os.makedirs(output_dir, exist_ok=True)
+        self._batch_dir = output_dir
+        self._batch_file = os.path.join(output_dir, 'batch.txt')
+        self._batch_names = []
+        # No -f: like the per-function runtime_full_* traces, only the profiling thread is
+        # followed, so other threads cannot leak into a function's slice of the trace
+        self._batch_proc = subprocess.Popen(
+            ['strace', '-I', '1', '-p', str(os.getpid()), '-e', f'{STRACE_TRACE_FILTER},prctl',
+             '-o', self._batch_file],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        
+        # Wait once for strace to attach, instead of once per function
+        self._require_tracer(self._batch_proc)
+
+    def profile_function_in_runtime_batched(self, function_info):
+        """Profile function loading and execution under the strace started by start_batch_profiling"""
+        function_path = function_info['function_path']
+        function_name = function_info['name']
+        input_data = self._get_input_for_function(function_name)
+        
+        print(f"=== Profiling {function_name} in current runtime (batched) ===")
+        
+        # Thread names are limited to 15 characters, so markers carry an index into _batch_names
+        marker = len(self._batch_names)
+        self._batch_names.append(function_name)
+        
+        function_result = None
+        error_msg = None
+        
+        # === Start of profiled section: function loading and execution ===
+        imports = _snapshot_imports()
+        warm_imports = bool(self._imports_kept)
+        thread_name = _set_thread_name(f"PROF_BEG:{marker}")
+        try:
+            func_module, _ = self._load_function_module(function_path)
+            function_result = func_module.handler(input_data)
+        except Exception as e:
+            error_msg = str(e)
+        finally:
+            _set_thread_name(f"PROF_END:{marker}")
+            _set_thread_name(thread_name)
+            self._imports_kept |= _restore_imports(imports)
+        # === End of profiled section ===
+        
+        return {
+            'function_name': function_name,
+            'profiling_mode': 'runtime_batched',
+            'success': True,
+            'function_result': function_result,
+            'error': error_msg,
+            'input_data': input_data,
+            'imports_isolated': not warm_imports,
+            'imports_kept': sorted(self._imports_kept),
+            'strace_file': os.path.join(self._batch_dir, f"runtime_full_{function_name}.txt")
+        }
+
+    def finish_batch_profiling(self):
+        """Detach the batch strace and split its trace into per-function files"""
+        self._stop_tracer(self._batch_proc)
+        outputs = _split_batch_trace(self._batch_file, self._batch_names, self._batch_dir)
+        print(f"Batch strace split into {len(outputs)} files in {self._batch_dir}")
+        return outputs
+
+    def _template_main(self, conn, preload):
+        """Warm template process: import preload once, then fork one child per profiling request"""
+        for module_name in preload:
+            try:
+                importlib.import_module(module_name)
+            except ImportError:
+                pass
+        
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            
+            result_r, result_w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(result_r)
                 try:
-                    strace_proc.terminate()
-                    strace_proc.wait(timeout=5)
-                except:
-                    pass
+                    # Own process group, shared with the strace it starts, so a timeout kills both
+                    os.setpgid(0, 0)
+                    try:
+                        reply = self._run_in_template_child(*request)
+                    except Exception as e:
+                        reply = {'function_result': None, 'error': str(e), 'missing_module': None}
+                    try:
+                        payload = pickle.dumps(reply)
+                    except Exception:
+                        reply['function_result'] = repr(reply['function_result'])
+                        payload = pickle.dumps(reply)
+                    with os.fdopen(result_w, 'wb') as f:
+                        f.write(payload)
+                finally:
+                    os._exit(0)
+            
+            os.close(result_w)
+            try:
+                os.setpgid(pid, pid)
+            except OSError:
+                pass
+            # The caller enforces the deadline: it kills the group, which ends the read below
+            conn.send(pid)
+            with os.fdopen(result_r, 'rb') as f:
+                payload = f.read()
+            os.waitpid(pid, 0)
+            conn.send(pickle.loads(payload) if payload else {'error': 'Template child exited without a result'})
 
-    def profile_full_python(self, function_info):
-        """Profile entire Python execution including startup and function execution"""
-        import tempfile
+    def _run_in_template_child(self, function_path, input_data, strace_file):
+        """Load and run one function in a forked template child, under strace -c attached to it"""
+        reply = {'function_result': None, 'error': None, 'missing_module': None, 'traced': False}
+        _allow_any_ptracer()
+        strace_proc = subprocess.Popen(
+            ['strace', '-I', '1', '-c', '-f', '-p', str(os.getpid()), '-o', strace_file],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        try:
+            self._require_tracer(strace_proc)
+            reply['traced'] = True
+            
+            # === Start of profiled section: function loading and execution ===
+            try:
+                spec = importlib.util.spec_from_file_location("func_module", function_path)
+                func_module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(func_module)
+                reply['function_result'] = func_module.handler(input_data)
+            except ImportError as e:
+                reply['error'] = str(e)
+                reply['missing_module'] = e.name
+            except Exception as e:
+                reply['error'] = str(e)
+            # === End of profiled section ===
+        finally:
+            self._stop_tracer(strace_proc)
+        return reply
+
+    def _spawn_template(self):
+        """Start (or reuse) the warm template process; returns its request connection"""
+        if self._template is not None and self._template[0].is_alive():
+            return self._template[1]
+        self._close_template()
         
+        ctx = multiprocessing.get_context('fork')
+        conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(
+            target=self._template_main, args=(child_conn, list(self._template_preload)), daemon=True
+        )
+        proc.start()
+        child_conn.close()
+        self._template = (proc, conn)
+        return conn
+
+    def _close_template(self):
+        if self._template is None:
+            return
+        proc, conn = self._template
+        self._template = None
+        try:
+            conn.send(None)
+        except (OSError, ValueError):
+            pass
+        conn.close()
+        proc.join(timeout=5)
+        if proc.is_alive():
+            proc.kill()
+            proc.join()
+
+    def profile_in_template(self, function_info):
+        """Profile function loading and execution in a fork of a warm template process
+        
+        The template has already imported common benchmark dependencies (TEMPLATE_PRELOAD),
+        like a pre-warmed execution environment; neither Python startup nor those imports
+        are measured. The template is rebuilt with the missing package after an ImportError.
+        """
         function_path = function_info['function_path']
         function_name = function_info['name']
         input_data = self._get_input_for_function(function_name)
         
-        print(f"=== Profiling {function_name} with full Python execution ===")
+        print(f"=== Profiling {function_name} in a forked template process ===")
         print(f"Function path: {function_path}")
         print(f"Input data: {input_data}")
         
-        # Create output files for strace results
-        strace_summary_file = f"fullpython_summary_{function_name}.txt"
-        strace_full_file = f"fullpython_full_{function_name}.txt"
+        strace_summary_file = f"template_summary_{function_name}.txt"
         
-        # Create a temporary Python script to execute the function
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as temp_script:
-            script_content = f'''
-import importlib.util
-import json
-import sys
-from pathlib import Path
+        try:
+            conn = self._spawn_template()
+            conn.send((function_path, input_data, strace_summary_file))
+            child_pid = conn.recv() if conn.poll(10) else None
+            if child_pid is None or not conn.poll(60):
+                if child_pid is not None:
+                    # The forked child and its attached strace outlive the template otherwise
+                    try:
+                        os.killpg(child_pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                self._close_template()
+                return {
+                    'function_name': function_name,
+                    'profiling_mode': 'template_fork',
+                    'success': False,
+                    'error': 'Template execution timed out',
+                    'input_data': input_data
+                }
+            reply = conn.recv()
+            
+            missing_module = reply.get('missing_module')
+            if missing_module and missing_module not in self._template_preload:
+                self._template_preload.append(missing_module)
+                self._close_template()
+            
+            print(f"Template strace file saved: {strace_summary_file}")
+            
+            return {
+                'function_name': function_name,
+                'profiling_mode': 'template_fork',
+                # Failed strace attaches come back as an untraced reply
+                'success': reply.get('traced', False),
+                'function_result': reply.get('function_result'),
+                'error': reply.get('error'),
+                'input_data': input_data,
+                'strace_summary_file': strace_summary_file
+            }
+        except Exception as e:
+            self._close_template()
+            return {
+                'function_name': function_name,
+                'profiling_mode': 'template_fork',
+                'success': False,
+                'error': str(e),
+                'input_data': input_data
+            }
 
-# Function execution script
-function_path = "{function_path}"
-input_data = {repr(input_data)}
+    def parse_strace_summary(self, path):
+        """Parse an strace -c style summary file into a numpy structured array (SUMMARY_DTYPE)"""
+        import numpy as np
+        
+        return _summary_array(np.fromregex(path, SUMMARY_RE, dtype=SUMMARY_RAW_DTYPE))
 
-try:
-    # Load function module
-    spec = importlib.util.spec_from_file_location("func_module", function_path)
-    func_module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(func_module)
-    
-    # Execute function
-    result = func_module.handler(input_data)
-    
-    # Print result without extra output during strace
-    print(repr(result))
+    def parse_strace_summary_buffer(self, data):
+        """Parse strace -c style summary text (bytes or str) like parse_strace_summary"""
+        import numpy as np
         
-except Exception as e:
-    print(f"ERROR: {{e}}")
-    sys.exit(1)
-'''
-            temp_script.write(script_content)
-            temp_script_path = temp_script.name
+        if isinstance(data, bytes):
+            data = data.decode(errors='replace')
+        return _summary_array(np.array(SUMMARY_RE.findall(data), dtype=SUMMARY_RAW_DTYPE))
+
+    def parse_full_trace(self, path):
+        """Count the completed calls per syscall in a line-level strace file (pandas Series)
+        
+        The file is mmap'd and scanned by one findall() of FULL_TRACE_PATTERN, in RE2 when
+        the optional binding is installed, so no Python code runs per line.
+        """
+        import pandas as pd
+        
+        rows = []
+        if os.path.getsize(path):
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                rows = _full_trace_regex().findall(mm)
+        counts = pd.DataFrame(rows, columns=FULL_TRACE_COLUMNS).groupby('syscall').size()
+        counts.index = counts.index.map(bytes.decode)
+        return counts.sort_values(ascending=False)
+
+    def load_all_summaries(self, paths):
+        """Read and parse several summary files at once; returns {path: SUMMARY_DTYPE array}
         
+        With the liburing binding (pip install liburing) the opens, reads and closes are each
+        submitted to one io_uring as a batch; without it (or without kernel io_uring support)
+        the files are read in turn.
+        """
+        paths = list(paths)
         try:
-            # Run strace for summary (with -c flag)
-            strace_summary_cmd = ['strace', '-c', '-f', '-o', strace_summary_file, 'python3', temp_script_path]
-            
-            result_summary = subprocess.run(
-                strace_summary_cmd,
-                capture_output=True,
+            contents = _read_files_io_uring(paths)
+        except (ImportError, OSError):
+            contents = {}
+            for path in paths:
+                with open(path, 'rb') as f:
+                    contents[path] = f.read()
+        return {path: self.parse_strace_summary_buffer(contents[path]) for path in paths}
+
+    def summarize_results(self, results):
+        """Stack the syscall summaries of several profiling results into one DataFrame"""
+        import pandas as pd
+        
+        found = []
+        for result in results:
+            path = result.get('strace_summary_file')
+            if path is None and result.get('profiling_mode') == 'runtime_summary':
+                path = result.get('strace_file')
+            if result.get('success') and path is not None and os.path.exists(path):
+                found.append((result, path))
+        
+        summaries = self.load_all_summaries(dict.fromkeys(path for _, path in found))
+        frames = []
+        for result, path in found:
+            frame = pd.DataFrame(summaries[path])
+            frame.insert(0, 'profiling_mode', result['profiling_mode'])
+            frame.insert(0, 'function_name', result['function_name'])
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=['function_name', 'profiling_mode'] +
+                                [name for name, _ in SUMMARY_DTYPE])
+        return pd.concat(frames, ignore_index=True)
+
+    def _read_error_pipe(self, err_r):
+        """Drain the driver's error pipe (written by its excepthook)"""
+        chunks = []
+        while True:
+            chunk = os.read(err_r, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(err_r)
+        return b''.join(chunks).decode(errors='replace').strip() or None
+
+    def _driver_cmd(self, function_path, input_data, err_w):
+        """python3 -c command line running DRIVER_SCRIPT on one function"""
+        return ['python3', '-c', DRIVER_SCRIPT, function_path, json.dumps(input_data), str(err_w)]
+
+    def _trace_full_python_strace(self, strace_args, function_path, input_data):
+        """Run the driver under strace; returns the completed process and the driver's error"""
+        err_r, err_w = os.pipe()
+        try:
+            # Own session, so a timeout takes down strace together with the traced driver;
+            # killing only strace (as subprocess.run does) detaches and orphans the tracee
+            proc = subprocess.Popen(
+                ['strace'] + strace_args + self._driver_cmd(function_path, input_data, err_w),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
                 text=True,
-                timeout=60
+                pass_fds=(err_w,),
+                start_new_session=True
             )
-            
-            # Run strace for full trace (without -c flag)
-            strace_full_cmd = ['strace', '-f', '-o', strace_full_file, 'python3', temp_script_path]
-            
-            result_full = subprocess.run(
-                strace_full_cmd,
-                capture_output=True,
+            try:
+                stdout, stderr = proc.communicate(timeout=60)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.communicate()
+                raise
+        finally:
+            os.close(err_w)
+            error = self._read_error_pipe(err_r)
+        return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr), error
+
+    def _wait_for_bpftrace(self, proc, raw_output, timeout=10.0):
+        """Wait until bpftrace has attached its probes (BEGIN has printed its marker)"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"bpftrace exited early: {proc.stderr.read().strip()}")
+            with open(raw_output) as f:
+                if '@trace:' in f.read():
+                    return
+            time.sleep(0.01)
+        raise RuntimeError('bpftrace did not attach in time')
+
+    def _trace_full_python_bpftrace(self, function_path, input_data, summary_file, full_file):
+        """Run the driver once under bpftrace, collecting both the summary and the trace"""
+        # bpftrace -c splits its command on spaces, so start the driver ourselves behind
+        # GATE_SCRIPT, which execs it (keeping the PID the probes filter on) once they are attached.
+        # The gate cannot be a preexec_fn: Popen only returns after the child has exec'd
+        gate_r, gate_w = os.pipe()
+        err_r, err_w = os.pipe()
+        child = None
+        tracer = None
+        try:
+            child = subprocess.Popen(
+                ['python3', '-c', GATE_SCRIPT, str(gate_r)] +
+                self._driver_cmd(function_path, input_data, err_w),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
                 text=True,
-                timeout=60
+                pass_fds=(err_w, gate_r)
             )
+            os.close(err_w)
+            err_w = None
+            script = BPFTRACE_SCRIPT if full_file else BPFTRACE_SUMMARY_SCRIPT
+            with tempfile.NamedTemporaryFile(mode='r', suffix='.bt.txt') as raw_output:
+                tracer = subprocess.Popen(
+                    ['bpftrace', '-o', raw_output.name, '-e', script, str(child.pid)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True
+                )
+                self._wait_for_bpftrace(tracer, raw_output.name)
+                os.write(gate_w, b'1')
+                stdout, stderr = child.communicate(timeout=60)
+                # END prints the maps on SIGINT
+                tracer.send_signal(signal.SIGINT)
+                tracer.wait(timeout=10)
+                counts = _split_bpftrace_output(raw_output.name, summary_file, full_file)
+        finally:
+            for proc in (child, tracer):
+                if proc and proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            # Only read by _wait_for_bpftrace when bpftrace exits early
+            if tracer:
+                tracer.stderr.close()
+            for fd in (gate_r, gate_w, err_w):
+                if fd is not None:
+                    os.close(fd)
+            error = self._read_error_pipe(err_r)
+        return subprocess.CompletedProcess(child.args, child.returncode, stdout, stderr), error, counts
+
+    def profile_full_python(self, function_info, keep_raw=False):
+        """Profile entire Python execution including startup and function execution
+        
+        Per-syscall counts are returned as strace_summary; the line-level trace is only
+        written to strace_full_file when keep_raw=True.
+        """
+        function_path = function_info['function_path']
+        function_name = function_info['name']
+        input_data = self._get_input_for_function(function_name)
+        
+        print(f"=== Profiling {function_name} with full Python execution ===")
+        print(f"Function path: {function_path}")
+        print(f"Input data: {input_data}")
+        
+        # Create output files for strace results
+        strace_summary_file = f"fullpython_summary_{function_name}.txt"
+        strace_full_file = f"fullpython_full_{function_name}.txt"
+        
+        raw_file = strace_full_file if keep_raw else None
+        
+        strace_fifo = None
+        try:
+            if shutil.which('bpftrace') and os.geteuid() == 0:
+                # One traced run produces both the histogram and the trace
+                syscall_backend = 'bpftrace'
+                trace_filter = None
+                result_summary, driver_error, strace_counts = self._trace_full_python_bpftrace(
+                    function_path, input_data, strace_summary_file, raw_file
+                )
+            else:
+                syscall_backend = 'strace'
+                # No -e class filter: the -C summary comes from the same run, and the
+                # mmap/brk/futex/rt_sig* calls it would drop are most of Python startup
+                trace_filter = None
+                
+                # -C prints the regular trace and appends the -c summary table in one run,
+                # streamed through a FIFO so only the small summary table reaches the disk
+                strace_fifo = StraceFifo(raw_file)
+                result_summary, driver_error = self._trace_full_python_strace(
+                    ['-C', '-f', '-o', strace_fifo.path], function_path, input_data
+                )
+                strace_counts, summary_table = strace_fifo.collect()
+                with open(strace_summary_file, 'w') as f:
+                    f.write(summary_table)
             
-            # Parse function output from summary run (both should have same output)
+            # Parse function output from the traced run
             function_result = None
             error_msg = None
             
-            if result_summary.returncode == 0:
+            if driver_error:
+                error_msg = driver_error
+            elif result_summary.returncode == 0:
                 try:
                     # The output should be the repr() of the result
                     output_line = result_summary.stdout.strip()
-                    if output_line and not output_line.startswith('ERROR:'):
-                        function_result = eval(output_line)  # Safe since we control the output
+                    if output_line:
+                        function_result = ast.literal_eval(output_line)
                 except:
                     pass
             else:
-                if result_summary.stdout and result_summary.stdout.startswith('ERROR:'):
-                    error_msg = result_summary.stdout.split('ERROR:', 1)[1].strip()
-                else:
-                    error_msg = f"Process failed with exit code {result_summary.returncode}"
-                    if result_summary.stderr:
-                        error_msg += f": {result_summary.stderr}"
+                error_msg = f"Process failed with exit code {result_summary.returncode}"
+                if result_summary.stderr:
+                    error_msg += f": {result_summary.stderr}"
             
             print(f"Full Python strace files saved:")
             print(f"  Summary: {strace_summary_file}")
-            print(f"  Full trace: {strace_full_file}")
+            if keep_raw:
+                print(f"  Full trace: {strace_full_file}")
             
-            return {
+            result = {
                 'function_name': function_name,
                 'profiling_mode': 'full_python',
                 'success': True,
                 'function_result': function_result,
                 'error': error_msg,
                 'input_data': input_data,
+                'strace_summary': strace_counts,
                 'strace_summary_file': strace_summary_file,
-                'strace_full_file': strace_full_file,
+                'syscall_backend': syscall_backend,
+                'trace_filter': trace_filter,
                 'stdout': result_summary.stdout,
                 'stderr': result_summary.stderr
             }
+            if keep_raw:
+                result['strace_full_file'] = strace_full_file
+            return result
             
         except subprocess.TimeoutExpired:
             return {
@@ -267,14 +1447,39 @@ except Exception as e:
                 'input_data': input_data
             }
         finally:
-            # Cleanup temporary script
-            try:
-                os.unlink(temp_script_path)
-            except:
-                pass
+            if strace_fifo:
+                strace_fifo.close()
+
+
+_worker_profiler = None
+
+
+def _pool_worker(function_info):
+    """Run profile_full_python in a pool worker, with one profiler per worker process"""
+    global _worker_profiler
+    if _worker_profiler is None:
+        _worker_profiler = TrueRuntimeProfiler()
+    return _worker_profiler.profile_full_python(function_info)
+
+
+def profile_full_python_parallel(function_infos, max_workers=None):
+    """Profile several functions with profile_full_python concurrently, one process each
     
+    Output files are keyed by function name, so each function should appear only once.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as ex:
+        return list(ex.map(_pool_worker, function_infos))
+
+
 def main():
-    """Main function demonstrating both profiling methods"""
+    """Profile the benchmark functions with both profiling methods"""
+    import pandas as pd
+    
+    parser = argparse.ArgumentParser(description='Profile Python serverless functions with syscall tracing')
+    parser.add_argument('--function', metavar='NAME',
+                        help='profile only this function (e.g. 110.dynamic-html)')
+    args = parser.parse_args()
+    
     profiler = TrueRuntimeProfiler()
     
     print("=== True Runtime Profiler - Dual Mode Demo ===")
@@ -283,66 +1488,38 @@ def main():
     print("2. Full Python: Profile entire Python execution including runtime startup + function loading/exec")
     print()
     
-    # Find target function for testing
-    target_func = None
-    for func in profiler.functions:
-        if '110.dynamic-html' in func['name']:
-            target_func = func
-            break
-    
-    if target_func:
-        print(f"Testing with function: {target_func['name']}")
-        
-        # Profile with runtime-only method (summary)
-        print("\n1a. Profiling with runtime-only method (summary)...")
-        runtime_summary_result = profiler.profile_function_in_runtime(target_func, summary=True)
-        
-        # print("\n" + "="*60)
-        
-        # Profile with runtime-only method (full)
-        print("\n1b. Profiling with runtime-only method (full)...")
-        runtime_full_result = profiler.profile_function_in_runtime(target_func, summary=False)
-        
-        print("\n" + "="*60)
-        
-        # Profile with full Python method
-        print("\n2. Profiling with full Python method...")
-        fullpython_result = profiler.profile_full_python(target_func)
-        
-        print("\n" + "="*60)
-        
-        # Show results
-        print("\n=== Final Results ===")
-        
-        # if runtime_summary_result['success']:
-        #     print(f"Runtime-only profiling (summary):")
-        #     print(f"  Function executed: {'✓' if runtime_summary_result['function_result'] is not None else '✗'}")
-        #     if runtime_summary_result['function_result'] is not None:
-        #         print(f"  Function result: {runtime_summary_result['function_result']}")
-        #     if runtime_summary_result['error']:
-        #         print(f"  Function error: {runtime_summary_result['error']}")
-        
-        if runtime_full_result['success']:
-            print(f"\nRuntime-only profiling (full):")
-            print(f"  Function executed: {'✓' if runtime_full_result['function_result'] is not None else '✗'}")
-            if runtime_full_result['function_result'] is not None:
-                print(f"  Function result: {runtime_full_result['function_result']}")
-            if runtime_full_result['error']:
-                print(f"  Function error: {runtime_full_result['error']}")
-        
-        if fullpython_result['success']:
-            print(f"\nFull Python profiling:")
-            print(f"  Function executed: {'✓' if fullpython_result['function_result'] is not None else '✗'}")
-            if fullpython_result['function_result'] is not None:
-                print(f"  Function result: {fullpython_result['function_result']}")
-            if fullpython_result['error']:
-                print(f"  Function error: {fullpython_result['error']}")
-        
+    # Find target functions: the requested one, or every function with known inputs
+    if args.function:
+        targets = [func for func in profiler.functions if func['name'] == args.function]
     else:
+        targets = [func for func in profiler.functions if func['name'] in profiler.correct_inputs]
+    
+    if not targets:
         print("No suitable test function found")
         print("Available functions:")
         for func in profiler.functions[:5]:
             print(f"  - {func['name']} ({func['category']})")
+        return
+    
+    print(f"Testing with functions: {', '.join(func['name'] for func in targets)}")
+    
+    # Profile with runtime-only method (summary)
+    print("\n1. Profiling with runtime-only method (summary)...")
+    results = [profiler.profile_function_in_runtime(func, summary=True) for func in targets]
+    
+    print("\n" + "="*60)
+    
+    # Profile with full Python method, one worker process per function
+    print("\n2. Profiling with full Python method...")
+    results += profile_full_python_parallel(targets)
+    
+    print("\n" + "="*60)
+    
+    # Show results
+    print("\n=== Final Results ===")
+    df = pd.DataFrame(results)
+    print(df[['function_name', 'profiling_mode', 'success', 'error']].to_string())
+
 
 if __name__ == '__main__':
     main()